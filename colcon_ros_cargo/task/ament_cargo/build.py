@@ -1,8 +1,15 @@
 # Licensed under the Apache License, Version 2.0
 
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
 import os
 from pathlib import Path
+import re
+import shutil
 import subprocess
+import threading
+import time
 
 from colcon_cargo.task.cargo import CARGO_EXECUTABLE
 from colcon_cargo.task.cargo.build import CargoBuildTask
@@ -10,15 +17,60 @@ from colcon_core.logging import colcon_logger
 from colcon_core.plugin_system import satisfies_version
 from colcon_core.shell import create_environment_hook
 from colcon_core.task import TaskExtensionPoint
-import toml
+
+try:
+    import rtoml as _toml_reader
+    _TomlDecodeError = _toml_reader.TomlParsingError
+except ImportError:
+    try:
+        import tomllib as _toml_reader
+        _TomlDecodeError = _toml_reader.TOMLDecodeError
+    except ImportError:  # Python < 3.11
+        import toml as _toml_reader
+        _TomlDecodeError = _toml_reader.TomlDecodeError
 
 
 logger = colcon_logger.getChild(__name__)
 
-# Some logic needs to be executed once per run.
-# There are no colcon hooks for this, so it is shoehorned into the build step
-# with a global.
-package_paths = None
+# Maps each prefix to the mtime of its rust_packages index and the package
+# names found in it, see _get_cached_scan() and _scan_prefix().
+_prefix_scan_cache = {}
+# A scan is only cached if the index directory was last modified at least
+# this long ago. On file systems with coarse timestamps, an entry added in
+# the same tick as the previous change doesn't update the mtime.
+_RACY_MTIME_NS = 1_000_000_000
+
+_TOML_TABLE_HEADER = re.compile(r'^\s*\[')
+_CARGO_PACKAGE_TABLE = re.compile(r'^\s*\[\s*package\s*\]')
+_CARGO_PACKAGE_NAME = re.compile(r'^\s*name\s*=\s*"([^"\\]+)"')
+_TOML_BARE_KEY = re.compile(r'[A-Za-z0-9_-]+')
+
+
+class _WorkspaceState:
+    """The state shared by all ament_cargo packages built in one run.
+
+    Some logic needs to be executed once per run. There are no colcon hooks
+    for this, so it is shoehorned into the build step with a module-level
+    instance of this class.
+
+    Packages can be prepared concurrently, so the lock must be held while
+    updating the package paths and writing .cargo/config.toml.
+    """
+
+    def __init__(self):  # noqa: D107
+        self.lock = threading.Lock()
+        # All Rust packages seen so far, None before the first package
+        self.package_paths = None
+        # The .cargo directory in the workspace, set on the first write
+        self.cargo_config_dir = None
+        # The package paths in the .cargo/config.toml written by this process
+        self.written_package_paths = None
+        # The size and mtime of the file after it was last written, to notice
+        # if it has been replaced since
+        self.written_file_signature = None
+
+
+_workspace_state = _WorkspaceState()
 
 
 class AmentCargoBuildTask(CargoBuildTask):
@@ -37,6 +89,8 @@ class AmentCargoBuildTask(CargoBuildTask):
     def __init__(self):  # noqa: D107
         super().__init__()
         satisfies_version(TaskExtensionPoint.EXTENSION_POINT_VERSION, '^1.0')
+        # Resolved in _prepare
+        self._manifest_path = None
 
     def add_arguments(self, *, parser):  # noqa: D102
         parser.add_argument(
@@ -48,8 +102,7 @@ class AmentCargoBuildTask(CargoBuildTask):
             '.cargo/config.toml for subsequent builds with cargo.')
 
     def _prepare(self, env, additional_hooks):
-        ament_build = 'cargo ament-build --help'.split()
-        if subprocess.run(ament_build, capture_output=True).returncode != 0:
+        if not _has_ament_build():
             logger.error(
                 '\n\nament_cargo package found but cargo ament-build was '
                 'not detected.'
@@ -58,25 +111,29 @@ class AmentCargoBuildTask(CargoBuildTask):
             return 1
 
         args = self.context.args
-
-        global package_paths
-        if package_paths is None:
-            if args.lookup_in_workspace:
-                package_paths = find_workspace_cargo_packages(args.build_base, args.install_base)  # noqa: E501
-            else:
-                package_paths = {}
+        src_dir = Path(self.context.pkg.path).resolve()
+        self._manifest_path = str(src_dir / 'Cargo.toml')
 
         # Scan the install dirs, aka prefixes. Note that only those prefixes
         # will be scanned that are a dependency of the current package.
         new_package_paths = find_installed_cargo_packages(env)
-        # The new_package_paths cover only the dependencies of the
-        # current package, but .cargo/config.toml should contain all Rust
-        # packages seen during the build process (so that you can afterwards
-        # use cargo for every package in the workspace).
-        # Hence, the installed package paths need to be accumulated.
-        new_package_paths.update(package_paths)
-        package_paths = new_package_paths
-        write_cargo_config_toml(package_paths)
+
+        state = _workspace_state
+        with state.lock:
+            if state.package_paths is None:
+                if args.lookup_in_workspace:
+                    state.package_paths = find_workspace_cargo_packages(args.build_base, args.install_base)  # noqa: E501
+                else:
+                    state.package_paths = {}
+
+            # The new_package_paths cover only the dependencies of the
+            # current package, but .cargo/config.toml should contain all Rust
+            # packages seen during the build process (so that you can
+            # afterwards use cargo for every package in the workspace).
+            # Hence, the installed package paths need to be accumulated.
+            new_package_paths.update(state.package_paths)
+            state.package_paths = new_package_paths
+            write_cargo_config_toml(new_package_paths)
 
         additional_hooks += create_environment_hook(
             'ament_prefix_path',
@@ -88,13 +145,11 @@ class AmentCargoBuildTask(CargoBuildTask):
 
     def _build_cmd(self, cargo_args):
         args = self.context.args
-        src_dir = Path(self.context.pkg.path).resolve()
-        manifest_path = str(src_dir / 'Cargo.toml')
         return [
             CARGO_EXECUTABLE, 'ament-build',
             '--install-base', args.install_base,
             '--',
-            '--manifest-path', manifest_path,
+            '--manifest-path', self._manifest_path,
             '--target-dir', args.build_base,
             '--quiet'
         ] + cargo_args
@@ -104,18 +159,104 @@ class AmentCargoBuildTask(CargoBuildTask):
         pass
 
 
+@functools.lru_cache(maxsize=1)
+def _has_ament_build():
+    # The availability of the cargo subcommand doesn't change during a run
+    if CARGO_EXECUTABLE is None:
+        return False
+    # Cargo subcommands are executables named cargo-<subcommand>, usually
+    # found on the PATH
+    if shutil.which('cargo-ament-build') is not None:
+        return True
+    # Cargo also looks for subcommands in its own bin directory
+    result = subprocess.run(
+        [CARGO_EXECUTABLE, '--list'], capture_output=True, text=True)
+    if result.returncode != 0:
+        return False
+    return any(
+        line.split()[:1] == ['ament-build']
+        for line in result.stdout.splitlines())
+
+
 def write_cargo_config_toml(package_paths):
     """Write the resolved package paths to config.toml.
 
+    Package paths are only ever added during a build, so new entries are
+    appended to the file written before. The file is rewritten when it
+    doesn't exist yet, has been modified by someone else since (e.g. another
+    colcon run in the same workspace) or the path of a known package has
+    changed.
+
+    When packages are built in parallel, the lock of the workspace state must
+    be held by the caller.
+
     :param package_paths: A mapping of package names to paths
     """
-    patches = {pkg: {'path': str(path)} for pkg, path in package_paths.items()}
-    content = {'patch': {'crates-io': patches}}
-    config_dir = Path.cwd() / '.cargo'
-    config_dir.mkdir(exist_ok=True)
-    cargo_config_toml_out = config_dir / 'config.toml'
-    with cargo_config_toml_out.open('w') as toml_file:
-        toml.dump(content, toml_file)
+    state = _workspace_state
+    package_paths = {pkg: str(path) for pkg, path in package_paths.items()}
+    if state.cargo_config_dir is None:
+        state.cargo_config_dir = os.path.join(os.getcwd(), '.cargo')
+        os.makedirs(state.cargo_config_dir, exist_ok=True)
+    cargo_config_toml_out = os.path.join(
+        state.cargo_config_dir, 'config.toml')
+
+    written_package_paths = state.written_package_paths
+    if written_package_paths is not None and all(
+        package_paths.get(pkg) == path
+        for pkg, path in written_package_paths.items()
+    ):
+        new_entries = ''.join(
+            _format_patch_entry(pkg, path)
+            for pkg, path in package_paths.items()
+            if pkg not in written_package_paths)
+        if not new_entries:
+            return
+        if _get_file_signature(cargo_config_toml_out) == \
+                state.written_file_signature:
+            with open(cargo_config_toml_out, 'a', encoding='utf-8') as f:
+                f.write(new_entries)
+            state.written_package_paths = package_paths
+            state.written_file_signature = _get_file_signature(
+                cargo_config_toml_out)
+            return
+
+    content = ''.join(
+        ['[patch.crates-io]\n'] + [
+            _format_patch_entry(pkg, path)
+            for pkg, path in package_paths.items()])
+    # Replace the file in one step, so that cargo never sees a partial file
+    tmp_path = os.path.join(
+        state.cargo_config_dir, f'.config.toml.{os.getpid()}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as toml_file:
+        toml_file.write(content)
+    os.replace(tmp_path, cargo_config_toml_out)
+    state.written_package_paths = package_paths
+    state.written_file_signature = _get_file_signature(cargo_config_toml_out)
+
+
+def _get_file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+def _format_patch_entry(pkg, path):
+    key = _format_toml_key(pkg)
+    return f'{key} = {{ path = {_format_toml_string(path)} }}\n'
+
+
+def _format_toml_key(key):
+    if _TOML_BARE_KEY.fullmatch(key):
+        return key
+    return _format_toml_string(key)
+
+
+def _format_toml_string(value):
+    # A JSON string is a valid TOML basic string, apart from the DEL character
+    # which TOML requires to be escaped
+    return json.dumps(value, ensure_ascii=False).replace('\x7f', '\\u007f')
 
 
 def find_installed_cargo_packages(env):
@@ -123,7 +264,7 @@ def find_installed_cargo_packages(env):
 
     :param env: Environment dict for this package
     :returns: A mapping of package names to paths
-    :rtype dict(str, Path)
+    :rtype dict(str, str)
     """
     prefix_for_package = {}
     ament_prefix_path_var = env.get('AMENT_PREFIX_PATH')
@@ -132,48 +273,189 @@ def find_installed_cargo_packages(env):
                        'You probably intended to source a ROS installation.')
         prefixes = []
     else:
-        prefixes = ament_prefix_path_var.split(os.pathsep)
-    for prefix in prefixes:
-        prefix = Path(prefix)
-        packages_dir = prefix / 'share' / 'ament_index' / 'resource_index' \
-            / 'rust_packages'
-        if packages_dir.exists():
-            packages = {path.name for path in packages_dir.iterdir()}
-        else:
-            packages = set()
+        # Scan every prefix only once. Packages from later prefixes take
+        # precedence, so the last occurrence of a repeated prefix is kept.
+        prefixes = list(dict.fromkeys(
+            reversed(ament_prefix_path_var.split(os.pathsep))))[::-1]
+    # Most prefixes are unchanged since the previous package, checking the
+    # cache costs a single stat per prefix
+    packages_per_prefix = [_get_cached_scan(prefix) for prefix in prefixes]
+    missed = [
+        prefix for prefix, packages in zip(prefixes, packages_per_prefix)
+        if packages is None]
+    if len(missed) > 1:
+        # The scans are dominated by file system calls, which release the GIL
+        with ThreadPoolExecutor(max_workers=min(8, len(missed))) as pool:
+            scanned = dict(zip(missed, pool.map(_scan_prefix, missed)))
+    else:
+        scanned = {prefix: _scan_prefix(prefix) for prefix in missed}
+    for prefix, packages in zip(prefixes, packages_per_prefix):
+        if packages is None:
+            packages = scanned[prefix]
         for pkg in packages:
             prefix_for_package[pkg] = prefix
-    return {pkg: str(prefix / 'share' / pkg / 'rust')
+    return {pkg: os.path.join(prefix, 'share', pkg, 'rust')
             for pkg, prefix in prefix_for_package.items()}
 
 
+def _get_rust_packages_dir(prefix):
+    return os.path.join(
+        prefix, 'share', 'ament_index', 'resource_index', 'rust_packages')
+
+
+def _get_cached_scan(prefix):
+    """Look up the cached Rust packages of a prefix.
+
+    Every package being built scans the same prefixes, so the result of
+    _scan_prefix() is cached until the modification time of the index
+    directory changes, i.e. until a package is added to or removed from the
+    prefix.
+
+    :param prefix: An entry of AMENT_PREFIX_PATH
+    :returns: The names of the Rust packages installed in the prefix, or None
+      if the prefix needs to be scanned
+    :rtype tuple(str)
+    """
+    try:
+        mtime_ns = os.stat(_get_rust_packages_dir(prefix)).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return ()
+    cached = _prefix_scan_cache.get(prefix)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+    return None
+
+
+def _scan_prefix(prefix):
+    """List the Rust packages registered in the ament index of a prefix.
+
+    The result is cached for _get_cached_scan(). Like git does for racy index
+    entries, a directory modified within the last second is not cached, since
+    a later change might not update its mtime.
+
+    :param prefix: An entry of AMENT_PREFIX_PATH
+    :returns: The names of the Rust packages installed in the prefix
+    :rtype tuple(str)
+    """
+    packages_dir = _get_rust_packages_dir(prefix)
+    try:
+        mtime_ns = os.stat(packages_dir).st_mtime_ns
+        with os.scandir(packages_dir) as entries:
+            packages = tuple(entry.name for entry in entries)
+    except (FileNotFoundError, NotADirectoryError):
+        _prefix_scan_cache.pop(prefix, None)
+        return ()
+    if time.time_ns() - mtime_ns >= _RACY_MTIME_NS:
+        _prefix_scan_cache[prefix] = (mtime_ns, packages)
+    else:
+        _prefix_scan_cache.pop(prefix, None)
+    return packages
+
+
 def find_workspace_cargo_packages(build_base, install_base):
     """Find Cargo packages in the workspace/current working directory.
 
     :param install_base: The install base of the current build
     :returns: A mapping of package names to paths
-    :rtype dict(str, Path)
+    :rtype dict(str, str)
     """
     path_for_package = {}
-    for (dirpath, dirnames, filenames) in os.walk(Path.cwd(), topdown=True):
-        # Users will often build the workspace several times into differently
-        # named install directories, and we don't know their names. So if we
-        # just scan through the current working directory, we'll probably find
-        # Rust packages in those install directories. That's not what we want,
-        # so install directories (identified by a setup.sh file) should be
-        # skipped.
-        if dirpath == install_base or (Path(dirpath) / 'setup.sh').exists():
-            # Do not descend into this directory
-            dirnames[:] = []
-        elif dirpath == build_base or (Path(dirpath) / 'COLCON_IGNORE').exists():  # noqa: E501
-            # In particular, build dirs have a COLCON_IGNORE
-            # Do not descend into this directory
-            dirnames[:] = []
-        elif 'Cargo.toml' in filenames:
-            try:
-                cargo_toml = toml.load(Path(dirpath) / 'Cargo.toml')
-                name = cargo_toml['package']['name']
-                path_for_package[name] = dirpath
-            except toml.decoder.TomlDecodeError:
-                pass
+    for dirpath in _walk_cargo_package_dirs(
+        os.getcwd(), build_base, install_base
+    ):
+        name = _read_cargo_package_name(os.path.join(dirpath, 'Cargo.toml'))
+        if name is not None:
+            path_for_package[name] = dirpath
     return path_for_package
+
+
+def _walk_cargo_package_dirs(dirpath, build_base, install_base):
+    """Find the directories containing a Cargo.toml file.
+
+    Each directory is listed once with os.scandir, which also reveals the
+    marker files of directories that should be skipped, so no additional
+    stat calls are needed.
+
+    :param dirpath: The directory to start the search in
+    :param build_base: The build base of the current build
+    :param install_base: The install base of the current build
+    :returns: An iterator over the directory paths, in top-down order
+    """
+    if dirpath == install_base or dirpath == build_base:
+        return
+    subdirs = []
+    has_cargo_toml = False
+    try:
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # Hidden directories and Cargo target directories don't
+                    # contain workspace packages
+                    if entry.name[0] != '.' and entry.name != 'target':
+                        subdirs.append(entry.path)
+                # Users will often build the workspace several times into
+                # differently named install directories, and we don't know
+                # their names. So if we just scan through the current working
+                # directory, we'll probably find Rust packages in those
+                # install directories. That's not what we want, so install
+                # directories (identified by a setup.sh file) should be
+                # skipped. Build dirs, like all ignored dirs, have a
+                # COLCON_IGNORE.
+                elif entry.name in ('setup.sh', 'COLCON_IGNORE'):
+                    # Do not descend into this directory
+                    return
+                elif entry.name == 'Cargo.toml' and entry.is_file():
+                    has_cargo_toml = True
+    except OSError:
+        return
+    if has_cargo_toml:
+        yield dirpath
+    for subdir in subdirs:
+        yield from _walk_cargo_package_dirs(subdir, build_base, install_base)
+
+
+def _read_cargo_package_name(path):
+    """Read the package name from a Cargo.toml file.
+
+    Most manifests start with a [package] table containing a plain
+    name = "..." line, which is found by scanning the file line by line.
+    Only if that fails, the whole file is parsed.
+
+    :param path: The path of the Cargo.toml file
+    :returns: The package name, or None for virtual or invalid manifests
+    :rtype str
+    """
+    with open(path, encoding='utf-8') as cargo_toml:
+        in_package = False
+        for line in cargo_toml:
+            # Lines of multi-line strings can't be told apart from keys
+            # without a parser
+            if '"""' in line or "'''" in line:
+                break
+            if _TOML_TABLE_HEADER.match(line):
+                if in_package or not _CARGO_PACKAGE_TABLE.match(line):
+                    break
+                in_package = True
+            elif in_package:
+                match = _CARGO_PACKAGE_NAME.match(line)
+                if match:
+                    return match.group(1)
+    try:
+        cargo_toml = _load_toml(path)
+    except _TomlDecodeError:
+        return None
+    return cargo_toml.get('package', {}).get('name')
+
+
+def _load_toml(path):
+    """Parse a TOML file with the fastest parser available.
+
+    rtoml is preferred if it is installed, then tomllib from the standard
+    library, and toml on older Python versions without tomllib.
+
+    :param path: The path of the TOML file
+    :returns: The parsed document
+    :rtype dict
+    """
+    with open(path, 'rb') as toml_file:
+        return _toml_reader.loads(toml_file.read().decode('utf-8'))
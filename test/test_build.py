@@ -6,6 +6,7 @@ import os
 from pathlib import Path
 import shutil
 import tempfile
+import time
 from types import SimpleNamespace
 import xml.etree.ElementTree as eTree
 
@@ -14,7 +15,15 @@ from colcon_core.package_descriptor import PackageDescriptor
 from colcon_core.subprocess import new_event_loop
 from colcon_core.task import TaskContext
 from colcon_ros.package_identification.ros import RosPackageIdentification
+from colcon_ros_cargo.task.ament_cargo.build import _load_toml
+from colcon_ros_cargo.task.ament_cargo.build import _read_cargo_package_name
+from colcon_ros_cargo.task.ament_cargo.build import _WorkspaceState
 from colcon_ros_cargo.task.ament_cargo.build import AmentCargoBuildTask
+from colcon_ros_cargo.task.ament_cargo.build import \
+    find_installed_cargo_packages
+from colcon_ros_cargo.task.ament_cargo.build import \
+    find_workspace_cargo_packages
+from colcon_ros_cargo.task.ament_cargo.build import write_cargo_config_toml
 from colcon_ros_cargo.task.ament_cargo.test import AmentCargoTestTask
 import pytest
 
@@ -41,6 +50,122 @@ def test_package_identification():
     assert desc.name == TEST_PACKAGE_NAME
 
 
+def test_read_cargo_package_name(tmp_path):
+    assert _read_cargo_package_name(
+        test_project_path / 'Cargo.toml') == TEST_PACKAGE_NAME
+
+    cargo_toml = tmp_path / 'Cargo.toml'
+    # Not found by the line scanner, the whole file needs to be parsed
+    cargo_toml.write_text(
+        "[package]\nversion = '0.1.0'\nname = 'single-quoted'\n")
+    assert _read_cargo_package_name(cargo_toml) == 'single-quoted'
+
+    # Escape sequences are only understood by the TOML parser
+    cargo_toml.write_text('[package]\nname = "fo\\u006fo"\n')
+    assert _read_cargo_package_name(cargo_toml) == 'fooo'
+
+    # A line of a multi-line string is not a key
+    cargo_toml.write_text(
+        '[package]\ndescription = """\nname = "wrong"\n"""\n'
+        'name = "right"\n')
+    assert _read_cargo_package_name(cargo_toml) == 'right'
+
+    # Virtual manifest
+    cargo_toml.write_text('[workspace]\nmembers = ["a", "b"]\n')
+    assert _read_cargo_package_name(cargo_toml) is None
+
+    cargo_toml.write_text('[package\n')
+    assert _read_cargo_package_name(cargo_toml) is None
+
+
+def test_find_workspace_cargo_packages(tmp_path, monkeypatch):
+    # os.getcwd() returns the resolved path
+    tmp_path = tmp_path.resolve()
+
+    def add_package(path, name):
+        path.mkdir(parents=True)
+        (path / 'Cargo.toml').write_text(f'[package]\nname = "{name}"\n')
+
+    add_package(tmp_path / 'src' / 'a', 'a')
+    add_package(tmp_path / 'src' / 'b' / 'nested', 'nested')
+    # Virtual manifests are skipped
+    (tmp_path / 'src' / 'b' / 'Cargo.toml').write_text(
+        '[workspace]\nmembers = ["nested"]\n')
+    # Packaged crates in target directories are skipped
+    add_package(tmp_path / 'src' / 'a' / 'target' / 'package' / 'a', 'a')
+    # Hidden directories are skipped
+    add_package(tmp_path / '.hidden' / 'c', 'c')
+    # Install directories, identified by a setup.sh, are skipped
+    add_package(tmp_path / 'other_install' / 'd', 'd')
+    (tmp_path / 'other_install' / 'setup.sh').touch()
+    # Directories with a COLCON_IGNORE are skipped
+    add_package(tmp_path / 'ignored' / 'e', 'e')
+    (tmp_path / 'ignored' / 'COLCON_IGNORE').touch()
+    # The build and install bases are skipped
+    add_package(tmp_path / 'build' / 'f', 'f')
+    add_package(tmp_path / 'install' / 'g', 'g')
+
+    monkeypatch.chdir(tmp_path)
+    assert find_workspace_cargo_packages(
+        str(tmp_path / 'build'), str(tmp_path / 'install')
+    ) == {
+        'a': str(tmp_path / 'src' / 'a'),
+        'nested': str(tmp_path / 'src' / 'b' / 'nested'),
+    }
+
+
+def test_find_installed_cargo_packages_racy_mtime(tmp_path):
+    packages_dir = tmp_path / 'share' / 'ament_index' / 'resource_index' / \
+        'rust_packages'
+    packages_dir.mkdir(parents=True)
+    (packages_dir / 'a').touch()
+    mtime_ns = time.time_ns()
+    os.utime(packages_dir, ns=(mtime_ns, mtime_ns))
+    env = {'AMENT_PREFIX_PATH': str(tmp_path)}
+    assert set(find_installed_cargo_packages(env)) == {'a'}
+
+    # Simulate a coarse timestamp which doesn't change with the new entry
+    (packages_dir / 'b').touch()
+    os.utime(packages_dir, ns=(mtime_ns, mtime_ns))
+    assert set(find_installed_cargo_packages(env)) == {'a', 'b'}
+
+
+def test_write_cargo_config_toml(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        'colcon_ros_cargo.task.ament_cargo.build._workspace_state',
+        _WorkspaceState())
+    config_toml = tmp_path / '.cargo' / 'config.toml'
+
+    def check_config(package_paths):
+        write_cargo_config_toml(package_paths)
+        assert _load_toml(config_toml) == {'patch': {'crates-io': {
+            pkg: {'path': path} for pkg, path in package_paths.items()}}}
+
+    # A stale file from a previous run is replaced
+    config_toml.parent.mkdir()
+    config_toml.write_text('[patch.crates-io]\nstale = { path = "/" }\n')
+    package_paths = {'rclrs': '/opt/ros/share/rclrs/rust'}
+    check_config(package_paths)
+    assert os.listdir(config_toml.parent) == ['config.toml']
+
+    # New packages are appended
+    package_paths['odd.name'] = 'C:\\ros\\"quoted"\\rust'
+    package_paths['trailing-newline\n'] = '/ws/src/trailing'
+    check_config(package_paths)
+
+    # A file replaced by someone else is rewritten instead of appended to,
+    # which would duplicate the keys it already contains
+    config_toml.write_text(
+        '[patch.crates-io]\nnew = { path = "/ws/src/new" }\n')
+    package_paths['new'] = '/ws/src/new'
+    check_config(package_paths)
+
+    # A changed path requires a rewrite
+    package_paths['rclrs'] = '/ws/install/share/rclrs/rust'
+    check_config(package_paths)
+
+
 @pytest.mark.skipif(
     not shutil.which('cargo'),
     reason='Rust must be installed to run this test')